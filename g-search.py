@@ -1,23 +1,34 @@
 import re
+import io
+import base64
 import os
 import sys
 import time
+import zlib
+import gzip
 import codecs
+import hashlib
+import argparse
+import collections
+import copy
+import json
 import random
 import shutil
-import requests
+import tempfile
+import signal
+import threading
 import configparser
-import pandas as pd
 from pathlib import Path
-from chardet import detect
+from contextlib import contextmanager, redirect_stdout
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from datetime import datetime
-from selenium import webdriver
-from urllib.parse import unquote, urlparse
-from bs4 import BeautifulSoup as BS
-from selenium.webdriver.chrome.options import Options
+from urllib.parse import parse_qs, unquote, urlparse
+# pandas, lxml, selenium, requests and chardet are imported where they are used,
+# so a command only loads what it needs
 
 
 def _load_config():
+    from chardet import detect
     config_path = "./config.ini"
     with open(config_path, "rb") as ef:
         config_encoding = detect(ef.read())["encoding"]
@@ -26,13 +37,979 @@ def _load_config():
     return config
 
 
-def _requests_retry_session(config, status_forcelist=(500, 502, 504), session=None):
-    session = requests.session()
+def _requests_retry_session(config, retries=3, backoff_factor=0.5, status_forcelist=(500, 502, 504), session=None, pool_size=4):
+    import requests
+    from requests.adapters import HTTPAdapter
+    from urllib3.util.retry import Retry
+    session = session or requests.session()
     headers = {"user-agent": config["Requests_header"]["user-agent"]}
     session.headers.update(headers)
+    retry = Retry(
+        total=retries,
+        connect=retries,
+        read=retries,
+        backoff_factor=backoff_factor,
+        status_forcelist=status_forcelist,
+        allowed_methods=frozenset(["GET"])
+    )
+    # Keep-alive connections are reused between pages of the same egress
+    adapter = HTTPAdapter(max_retries=retry, pool_connections=pool_size, pool_maxsize=pool_size)
+    session.mount("http://", adapter)
+    session.mount("https://", adapter)
     return session
 
 
+class _Metrics:
+    def __init__(self):
+        self._samples = collections.defaultdict(list)
+        self._counters = collections.defaultdict(collections.Counter)
+        self._file = None
+        self._lock = threading.Lock()
+
+    def open(self, metrics_path):
+        metrics_dir = os.path.dirname(metrics_path)
+        if not os.path.exists(metrics_dir):
+            os.makedirs(metrics_dir)
+        self._file = open(metrics_path, "a", encoding="utf-8")
+
+    def close(self):
+        if self._file is not None:
+            self._file.close()
+            self._file = None
+
+    def _write(self, line):
+        if self._file is not None:
+            line["time"] = datetime.now().isoformat(timespec="milliseconds")
+            self._file.write(json.dumps(line, ensure_ascii=False) + "\n")
+
+    def record(self, stage, secs, **labels):
+        with self._lock:
+            self._samples[stage].append(secs)
+            self._write(dict(stage=stage, secs=round(secs, 4), **labels))
+
+    @contextmanager
+    def stage(self, stage, **labels):
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(stage, time.perf_counter() - start, **labels)
+
+    def count(self, counter, project=None, n=1, **labels):
+        with self._lock:
+            self._counters[project][counter] += n
+            self._write(dict(counter=counter, n=n, project=project, **labels))
+
+    def summary(self):
+        with self._lock:
+            lines = ["{:<14}{:>8}{:>10}{:>9}{:>9}{:>9}".format("stage", "count", "total(s)", "p50", "p95", "max")]
+            for stage, samples in sorted(self._samples.items(), key=lambda item: -sum(item[1])):
+                samples = sorted(samples)
+                lines.append("{:<14}{:>8}{:>10.1f}{:>9.3f}{:>9.3f}{:>9.3f}".format(
+                    stage, len(samples), sum(samples), _percentile(samples, 0.5), _percentile(samples, 0.95), samples[-1]))
+            for project, counter in self._counters.items():
+                lines.append("{}: {}".format(project, ", ".join("{} {}".format(k, v) for k, v in sorted(counter.items()))))
+        return "\n".join(lines)
+
+
+def _percentile(sorted_values, q):
+    return sorted_values[int(round((len(sorted_values) - 1) * q))]
+
+
+class _DriverPool:
+    def __init__(self, config, make_options, size=1, max_uses=50, metrics=None):
+        self.metrics = metrics or _Metrics()
+        self.config = config
+        # Chrome options are only built once a browser is launched
+        self.make_options = make_options
+        self.chrome_opt = None
+        self.size = max(1, size)
+        # Recycle a browser after this many borrows (0 = never)
+        self.max_uses = max_uses
+        # Most recently returned browser first
+        self._idle = []
+        self._uses = {}
+        self._live = 0
+        self._closed = False
+        # Waiters are woken when a browser comes back or a slot frees up
+        self._cond = threading.Condition()
+
+    def _launch(self):
+        from selenium import webdriver
+        if self.chrome_opt is None:
+            self.chrome_opt = self.make_options()
+        with self.metrics.stage("driver_start"):
+            driver = webdriver.Chrome(
+                executable_path=self.config["Chrome_Canary"]["CHROMEDRIVER_PATH"],
+                options=self.chrome_opt
+            )
+        self._uses[id(driver)] = 0
+        return driver
+
+    def _spawn(self):
+        with self._cond:
+            if self._closed or self._live >= self.size:
+                return None
+            self._live += 1
+        try:
+            return self._launch()
+        except Exception:
+            with self._cond:
+                self._live -= 1
+                self._cond.notify()
+            raise
+
+    def _healthy(self, driver):
+        try:
+            driver.execute_script("return 1;")
+            return True
+        except Exception:
+            return False
+
+    def _discard(self, driver):
+        self._uses.pop(id(driver), None)
+        try:
+            driver.quit()
+        except Exception:
+            pass
+        with self._cond:
+            self._live -= 1
+            self._cond.notify()
+
+    def _acquire(self):
+        while True:
+            with self._cond:
+                while not self._closed and not self._idle and self._live >= self.size:
+                    self._cond.wait()
+                if self._closed:
+                    raise RuntimeError("driver pool is closed")
+                driver = self._idle.pop() if self._idle else None
+            if driver is None:
+                # A free slot, though another waiter may take it first
+                driver = self._spawn()
+                if driver is None:
+                    continue
+                return driver
+            if self._healthy(driver):
+                return driver
+            self._discard(driver)
+
+    def _put_idle(self, driver):
+        with self._cond:
+            self._idle.append(driver)
+            self._cond.notify()
+
+    def _release(self, driver, broken=False):
+        self._uses[id(driver)] = self._uses.get(id(driver), 0) + 1
+        worn_out = self.max_uses > 0 and self._uses[id(driver)] >= self.max_uses
+        if broken or worn_out or self._closed:
+            self._discard(driver)
+        else:
+            self._put_idle(driver)
+
+    def warm_up(self):
+        # Start every browser up front so the first fetches don't pay for it
+        while True:
+            driver = self._spawn()
+            if driver is None:
+                return
+            self._put_idle(driver)
+
+    @contextmanager
+    def borrow(self):
+        driver = self._acquire()
+        broken = False
+        try:
+            yield driver
+        except Exception:
+            # Crashed or wedged browser, replace it on the next borrow
+            broken = True
+            raise
+        finally:
+            self._release(driver, broken)
+
+    def close(self):
+        with self._cond:
+            self._closed = True
+            idle, self._idle = self._idle, []
+            self._cond.notify_all()
+        for driver in idle:
+            self._discard(driver)
+
+
+class _SeleniumFetcher:
+    def __init__(self, driver_pool):
+        self.driver_pool = driver_pool
+
+    def fetch(self, url):
+        with self.driver_pool.borrow() as driver:
+            driver.get(url)
+            time.sleep(random.uniform(1, 2))
+            return driver.page_source
+
+    def warm_up(self):
+        self.driver_pool.warm_up()
+
+    def close(self):
+        self.driver_pool.close()
+
+
+class _HttpFetcher:
+    # A page without results/footer needs a real browser, a captcha goes back
+    # as it is so clean_page sees the ban and the pacer pauses
+    _captcha_mark = re.compile(r"id=[\"']?recaptcha\b")
+    _complete_marks = (re.compile(r"id=[\"']?rso\b"), re.compile(r"id=[\"']?footcnt\b"))
+
+    def __init__(self, session, fallback=None, base_url=None, timeout=9, max_fallbacks=3):
+        self.session = session
+        self.fallback = fallback
+        # Send the query to a local stand-in server instead of Google
+        self.base_url = base_url
+        self.timeout = timeout
+        # Every fallback is a second hit on Google; after this many in a row
+        # requests is given up and the browser fetches alone (0 = never)
+        self.max_fallbacks = max_fallbacks
+        self._fallbacks = 0
+
+    def fetch(self, url):
+        import requests
+        from chardet import detect
+        if self.base_url:
+            url = "{}?{}".format(self.base_url, urlparse(url).query)
+        if self.fallback is not None and 0 < self.max_fallbacks <= self._fallbacks:
+            return self.fallback.fetch(url)
+        try:
+            res = self.session.get(url, timeout=self.timeout)
+            if res.encoding is None:
+                res.encoding = detect(res.content)["encoding"]
+            res_text = res.text
+            # Asking the browser right away would only hit Google again while banned
+            if "/sorry/" in res.url or self._captcha_mark.search(res_text):
+                return res_text
+            reason = self.blocked(res, res_text)
+            if reason is None:
+                self._fallbacks = 0
+                return res_text
+        except requests.RequestException as e:
+            reason = type(e).__name__
+        if self.fallback is None:
+            raise RuntimeError("{} 無法取得: {}".format(url, reason))
+        self._fallbacks += 1
+        print("requests取得不完整 ({}) 改用瀏覽器".format(reason))
+        if self._fallbacks == self.max_fallbacks:
+            print("連續{}次取得不完整 之後只用瀏覽器".format(self._fallbacks))
+        return self.fallback.fetch(url)
+
+    def blocked(self, res, res_text):
+        if res.status_code != 200:
+            return "HTTP {}".format(res.status_code)
+        if not all(mark.search(res_text) for mark in self._complete_marks):
+            return "缺少搜尋結果"
+        return None
+
+    def warm_up(self):
+        # Chrome is only started once a page actually needs it
+        pass
+
+    def close(self):
+        self.session.close()
+        if self.fallback is not None:
+            self.fallback.close()
+
+
+class _CacheOnlyFetcher:
+    # html_preprocess never gets past the cache in match mode
+    def fetch(self, url):
+        raise LookupError("{} 不在快取".format(url))
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _ReplayFetcher:
+    def __init__(self, source):
+        # Either a directory of saved SERP html or the url of a local stand-in server
+        self.source = source
+        self.remote = source.startswith("http")
+        if not self.remote:
+            self.pages = sorted(f for f in os.listdir(source) if f.endswith(".html"))
+            if not self.pages:
+                raise ValueError("{} 沒有SERP html".format(source))
+
+    def fetch(self, url):
+        query = urlparse(url).query
+        if self.remote:
+            import requests
+            return requests.get("{}?{}".format(self.source, query), timeout=9).text
+        # "<keyword>_<start>.html" if saved, otherwise a stable pick among the fixtures
+        params = parse_qs(query)
+        name = "{}_{}.html".format(params.get("q", [""])[0], params.get("start", ["0"])[0])
+        if name not in self.pages:
+            name = self.pages[zlib.crc32(name.encode("utf-8")) % len(self.pages)]
+        with open(os.path.join(self.source, name), "r", encoding="utf-8") as page:
+            return page.read()
+
+    def warm_up(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class _SerpCache:
+    def __init__(self, cache_dir, ttl=86400, max_bytes=512 * 1024 * 1024):
+        # Entries expire ttl seconds after being written (mtime); when the
+        # directory grows past max_bytes the least recently read (atime) go first
+        self.cache_dir = cache_dir
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        if not os.path.exists(cache_dir):
+            os.makedirs(cache_dir)
+        self._total = 0
+        self._locks = {}
+        self._lock = threading.Lock()
+        # Past days are never asked for again, so get() alone would never expire them
+        for stat, path in self._expire(self._entries()):
+            self._total += stat.st_size
+
+    def _path(self, key):
+        digest = hashlib.sha1("\t".join(str(k) for k in key).encode("utf-8")).hexdigest()
+        return os.path.join(self.cache_dir, "{}.html.gz".format(digest))
+
+    @contextmanager
+    def lock(self, key):
+        # Projects asking for the same query wait for the first fetch
+        with self._lock:
+            key_lock = self._locks.setdefault(key, threading.Lock())
+        with key_lock:
+            yield
+
+    def get(self, key):
+        path = self._path(key)
+        try:
+            stat = os.stat(path)
+        except FileNotFoundError:
+            return None
+        now = time.time()
+        if now - stat.st_mtime > self.ttl:
+            self._remove(path, stat.st_size)
+            return None
+        with gzip.open(path, "rt", encoding="utf-8") as load:
+            html = load.read()
+        os.utime(path, (now, stat.st_mtime))
+        return html
+
+    def put(self, key, html):
+        path = self._path(key)
+        tmp_path = "{}.tmp".format(path)
+        with gzip.open(tmp_path, "wt", encoding="utf-8", compresslevel=5) as save:
+            save.write(html)
+        size = os.path.getsize(tmp_path)
+        if os.path.exists(path):
+            size -= os.path.getsize(path)
+        os.replace(tmp_path, path)
+        with self._lock:
+            self._total += size
+        if self._total > self.max_bytes:
+            self._evict()
+
+    def _remove(self, path, size):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return
+        with self._lock:
+            self._total -= size
+
+    def _entries(self):
+        return [(entry.stat(), entry.path) for entry in os.scandir(self.cache_dir) if entry.is_file()]
+
+    def _expire(self, entries):
+        # Drop entries past ttl, return the ones left
+        now = time.time()
+        kept = []
+        for stat, path in entries:
+            if now - stat.st_mtime > self.ttl:
+                try:
+                    os.remove(path)
+                except FileNotFoundError:
+                    pass
+            else:
+                kept.append((stat, path))
+        return kept
+
+    def _evict(self):
+        entries = self._expire(self._entries())
+        with self._lock:
+            self._total = sum(stat.st_size for stat, path in entries)
+        entries.sort(key=lambda entry: entry[0].st_atime)
+        for stat, path in entries:
+            if self._total <= self.max_bytes * 0.9:
+                break
+            self._remove(path, stat.st_size)
+
+
+class _FrameStore:
+    _blob_ref = re.compile(r'<(script|style)\b([^>]*?) data-blob="([0-9a-f]{64})"></\1>')
+
+    def __init__(self, object_dir, min_blob=1024, enabled=True):
+        # Inline css/js repeats in every frame, so each distinct block is kept once
+        # as objects/<sha256[:2]>/<sha256>.gz and the gzipped frame keeps a reference
+        self.object_dir = object_dir
+        self.min_blob = min_blob
+        self.enabled = enabled
+
+    @staticmethod
+    def stem(frame_path):
+        name = os.path.basename(frame_path)
+        for suffix in (".html.gz", ".html"):
+            if name.endswith(suffix):
+                return name[:-len(suffix)]
+        return os.path.splitext(name)[0]
+
+    @staticmethod
+    def is_frame(name):
+        return name.endswith(".html") or name.endswith(".html.gz")
+
+    def _object_path(self, digest):
+        return os.path.join(self.object_dir, digest[:2], "{}.gz".format(digest))
+
+    def _put_object(self, text):
+        data = text.encode("utf-8")
+        digest = hashlib.sha256(data).hexdigest()
+        path = self._object_path(digest)
+        if not os.path.exists(path):
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            tmp_path = "{}.{}.tmp".format(path, threading.get_ident())
+            with gzip.open(tmp_path, "wb", compresslevel=5) as save:
+                save.write(data)
+            os.replace(tmp_path, path)
+        return digest
+
+    @staticmethod
+    def _same(save_path, text):
+        # An identical frame keeps its mtime, so its screenshot stays current
+        if not os.path.exists(save_path):
+            return False
+        opener = gzip.open if save_path.endswith(".gz") else open
+        with opener(save_path, "rt", encoding="utf-8") as load:
+            return load.read() == text
+
+    def save(self, root, path_stem):
+        if not self.enabled:
+            save_path = "{}.html".format(path_stem)
+            html = _serialize_html(root)
+            if not self._same(save_path, html):
+                with open(save_path, "w", encoding="utf-8") as save:
+                    save.write(html)
+            return save_path
+        blobs = []
+        try:
+            for el in root.iter("script", "style"):
+                if el.get("src") is None and el.text and len(el.text) >= self.min_blob:
+                    el.set("data-blob", self._put_object(el.text))
+                    blobs.append((el, el.text))
+                    el.text = None
+            skeleton = _serialize_html(root)
+        finally:
+            # The tree may still be in use, put it back as it was
+            for el, text in blobs:
+                el.text = text
+                del el.attrib["data-blob"]
+        save_path = "{}.html.gz".format(path_stem)
+        if not self._same(save_path, skeleton):
+            with gzip.open(save_path, "wt", encoding="utf-8", compresslevel=5) as save:
+                save.write(skeleton)
+        return save_path
+
+    def _inline(self, match):
+        with gzip.open(self._object_path(match.group(3)), "rt", encoding="utf-8") as load:
+            return "<{0}{1}>{2}</{0}>".format(match.group(1), match.group(2), load.read())
+
+    def load(self, frame_path):
+        if not frame_path.endswith(".gz"):
+            with open(frame_path, "r", encoding="utf-8") as load:
+                return load.read()
+        with gzip.open(frame_path, "rt", encoding="utf-8") as load:
+            return self._blob_ref.sub(self._inline, load.read())
+
+    @contextmanager
+    def materialized(self, frame_path):
+        # Chrome needs the whole page as a plain file
+        if not frame_path.endswith(".gz"):
+            yield frame_path
+            return
+        fd, page_path = tempfile.mkstemp(suffix=".html")
+        try:
+            with os.fdopen(fd, "w", encoding="utf-8") as save:
+                save.write(self.load(frame_path))
+            yield os.path.abspath(page_path).replace("\\", "/")
+        finally:
+            os.remove(page_path)
+
+
+class _TargetIndex:
+    url_pat = re.compile(r"(\/([\d\-\/]*))-.*")
+
+    def __init__(self, target_list, title_slice):
+        self.title_slice = title_slice
+        # Normalized url -> [(position, unquoted url)]
+        self.by_url = {}
+        # (hostname, title prefix) -> [position]
+        self.by_title = {}
+        for pos, target in enumerate(target_list):
+            if not isinstance(target[2], str):
+                continue
+            url = unquote(target[2])
+            self.by_url.setdefault(self.url_pat.sub(r"\1", url), []).append((pos, url))
+            if isinstance(target[1], str):
+                key = (urlparse(url).hostname, target[1][:title_slice])
+                self.by_title.setdefault(key, []).append(pos)
+
+    def match(self, href, title_part):
+        href = unquote(href)
+        found = set(pos for pos, url in self.by_url.get(self.url_pat.sub(r"\1", href), []) if url in href)
+        found.update(self.by_title.get((urlparse(href).hostname, title_part[:self.title_slice]), []))
+        return sorted(found)
+
+
+class _ResultJournal:
+    def __init__(self, result_path, flush_rows=200, flush_secs=30, metrics=None, submit=None, next_keyword=0):
+        self.metrics = metrics or _Metrics()
+        # Hands the disk writes to a background writer when pipelined
+        self.submit = submit
+        self.result_path = result_path
+        self.checkpoint_path = self.checkpoint_of(result_path)
+        self.flush_rows = flush_rows
+        self.flush_secs = flush_secs
+        self._rows = []
+        # Keywords may finish out of order; their rows wait here until every
+        # keyword before them is done, so the file and checkpoint stay in order
+        self._held = collections.defaultdict(list)
+        self._done = set()
+        self._next = next_keyword
+        self._last_flush = time.monotonic()
+        self._lock = threading.RLock()
+
+    @staticmethod
+    def checkpoint_of(result_path):
+        return "{}.ckpt".format(os.path.splitext(result_path)[0])
+
+    @staticmethod
+    def read_checkpoint(result_path):
+        checkpoint_path = _ResultJournal.checkpoint_of(result_path)
+        if not os.path.exists(checkpoint_path):
+            return None
+        with open(checkpoint_path, "r", encoding="utf-8") as check:
+            return json.load(check)
+
+    def _write_checkpoint(self, checkpoint):
+        # Replace atomically so a crash never leaves half a checkpoint
+        tmp_path = "{}.tmp".format(self.checkpoint_path)
+        with open(tmp_path, "w", encoding="utf-8") as save:
+            json.dump(checkpoint, save, ensure_ascii=False)
+        os.replace(tmp_path, self.checkpoint_path)
+
+    def write(self, row, keyword_index):
+        with self._lock:
+            self._held[keyword_index].append(row)
+
+    def keyword_done(self, keyword_index):
+        with self._lock:
+            self._done.add(keyword_index)
+            while self._next in self._done:
+                self._done.remove(self._next)
+                self._rows.extend(self._held.pop(self._next, []))
+                self._next += 1
+            if len(self._rows) >= self.flush_rows or time.monotonic() - self._last_flush >= self.flush_secs:
+                self.flush()
+
+    def _append(self, rows, position):
+        with self.metrics.stage("result_write", rows=len(rows)):
+            result_dir = os.path.dirname(self.result_path)
+            if not os.path.exists(result_dir):
+                os.makedirs(result_dir)
+            with open(self.result_path, "a", encoding="utf-8-sig") as result:
+                result.write("".join(rows))
+            # Rows go first: a stale checkpoint only repeats rows, which result_end drops
+            self._write_checkpoint({"next": position})
+
+    def flush(self, wait=False):
+        # wait: write on this thread, only once the background writer is drained
+        with self._lock:
+            if self._rows:
+                rows, self._rows = self._rows, []
+                if self.submit is None or wait:
+                    self._append(rows, self._next)
+                else:
+                    self.submit(self._append, rows, self._next)
+            self._last_flush = time.monotonic()
+
+    def finish(self):
+        with self._lock:
+            self.flush(wait=True)
+            self._write_checkpoint({"done": True})
+
+
+class _Pipeline:
+    def __init__(self, shot_workers):
+        # Frames and result rows are written in order on one thread,
+        # screenshots of written frames run on the others
+        self._writer = ThreadPoolExecutor(max_workers=1)
+        self._shooter = ThreadPoolExecutor(max_workers=shot_workers)
+        self._pending = collections.defaultdict(collections.deque)
+        self._lock = threading.Lock()
+
+    def _track(self, project, future, shot):
+        with self._lock:
+            self._pending[project].append((future, shot))
+        return future
+
+    def write(self, project, fn, *args):
+        return self._track(project, self._writer.submit(fn, *args), False)
+
+    def shoot(self, project, fn, *args):
+        return self._track(project, self._shooter.submit(fn, *args), True)
+
+    def drain(self, project):
+        # Writes may queue screenshots while draining, so pop until empty
+        pending = self._pending[project]
+        error = None
+        while True:
+            with self._lock:
+                if not pending:
+                    break
+                future, shot = pending.popleft()
+            try:
+                future.result()
+            except Exception as e:
+                if shot:
+                    # check_screenshot takes the frame again
+                    print("截圖失敗: {}".format(e))
+                elif error is None:
+                    error = e
+        if error is not None:
+            raise error
+
+    def close(self, cancel=False):
+        self._shooter.shutdown(wait=True, cancel_futures=cancel)
+        self._writer.shutdown(wait=True)
+
+
+class _CacheMiss(LookupError):
+    pass
+
+
+class _GoogleBanned(Exception):
+    def __init__(self, recapt_url):
+        super().__init__(recapt_url)
+        self.recapt_url = recapt_url
+
+
+class _Pacer:
+    def __init__(self, min_interval, max_interval, state_path=None, adaptive=False,
+                 step=0.5, backoff=2.0, ban_pause=900, max_bans=4):
+        # AIMD on the query rate: every clean page shortens the interval by step,
+        # a slow or incomplete page multiplies it by backoff, within Sleep_time
+        self.min_interval = min_interval
+        self.max_interval = max_interval
+        self.state_path = state_path
+        self.adaptive = adaptive
+        self.step = step
+        self.backoff = backoff
+        self.ban_pause = ban_pause
+        self.max_bans = max_bans
+        self.delay = (min_interval + max_interval) / 2
+        self.latency = None
+        self.samples = 0
+        # Bans in a row, only for this run; a new run starts back at the first pause
+        self.bans = 0
+        self._next = time.monotonic()
+        self._lock = threading.Lock()
+        if state_path is not None and os.path.exists(state_path):
+            with open(state_path, "r", encoding="utf-8") as load:
+                state = json.load(load)
+            self.delay = min(max(state["delay"], min_interval), max_interval)
+            self.latency = state["latency"]
+            self.samples = state["samples"]
+
+    def _interval(self):
+        if not self.adaptive:
+            return random.uniform(self.min_interval, self.max_interval)
+        # Some jitter so the queries don't tick like a clock
+        return min(max(random.uniform(0.75, 1.25) * self.delay, self.min_interval), self.max_interval)
+
+    def acquire(self):
+        with self._lock:
+            waited = max(self._next - time.monotonic(), 0)
+            time.sleep(waited)
+            return waited
+
+    def release(self):
+        # Like the old sleep after each page, the interval starts once the fetch is over
+        with self._lock:
+            self._next = time.monotonic() + self._interval()
+
+    def observe(self, latency, complete):
+        with self._lock:
+            slow = self.latency is not None and self.samples >= 5 and latency > 2 * self.latency
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            self.samples += 1
+            self.bans = 0
+            if not complete or slow:
+                self.delay = min(self.delay * self.backoff, self.max_interval)
+            else:
+                self.delay = max(self.delay - self.step, self.min_interval)
+            self._save()
+
+    def banned(self):
+        # Seconds to pause before trying the same page again, None to give up
+        with self._lock:
+            self.bans += 1
+            self.delay = self.max_interval
+            self._save()
+            if self.bans > self.max_bans:
+                return None
+            return self.ban_pause * 2 ** (self.bans - 1)
+
+    def _save(self):
+        if self.state_path is None:
+            return
+        state_dir = os.path.dirname(self.state_path)
+        if not os.path.exists(state_dir):
+            os.makedirs(state_dir)
+        tmp_path = "{}.tmp".format(self.state_path)
+        with open(tmp_path, "w", encoding="utf-8") as save:
+            json.dump({"delay": self.delay, "latency": self.latency, "samples": self.samples}, save)
+        os.replace(tmp_path, self.state_path)
+
+
+class _Egress:
+    def __init__(self, name, fetcher, pacer):
+        self.name = name
+        self.fetcher = fetcher
+        self.pacer = pacer
+
+
+class _Scheduler:
+    def __init__(self, runs):
+        # Projects take turns one keyword at a time, and a project with keywords
+        # left stays in turn while its earlier keywords still run elsewhere, so
+        # every egress profile has work; the journal keeps the keyword order
+        self._ready = collections.deque(runs)
+        self._running = collections.Counter()
+        # Out of keywords but not done yet, closed by whoever finishes the last one
+        self._draining = set()
+        self._busy = 0
+        self._stopped = False
+        self._error = None
+        self._cond = threading.Condition()
+
+    def next_job(self):
+        with self._cond:
+            while not self._stopped:
+                if self._ready:
+                    run = self._ready.popleft()
+                    job = next(run.pending, None)
+                    if job is None and self._running[run]:
+                        self._draining.add(run)
+                        continue
+                    self._busy += 1
+                    if job is not None:
+                        self._running[run] += 1
+                        self._ready.append(run)
+                    # None means every keyword is done and the project can be closed
+                    return run, job
+                if self._busy == 0:
+                    break
+                self._cond.wait()
+            return None, None
+
+    def job_done(self, run, job):
+        with self._cond:
+            self._busy -= 1
+            if job is not None:
+                self._running[run] -= 1
+                if not self._running[run] and run in self._draining:
+                    self._draining.remove(run)
+                    self._ready.append(run)
+            self._cond.notify_all()
+
+    def work(self, egress):
+        while True:
+            run, job = self.next_job()
+            if run is None:
+                return
+            try:
+                if job is None:
+                    run.finish_project()
+                else:
+                    run.run_keyword(job, egress)
+            except BaseException as e:
+                with self._cond:
+                    if self._error is None:
+                        self._error = e
+                self.stop()
+                return
+            finally:
+                self.job_done(run, job)
+
+    def stop(self):
+        with self._cond:
+            self._stopped = True
+            self._cond.notify_all()
+
+    def raise_error(self):
+        if self._error is not None:
+            raise self._error
+
+
+def _write_frame(df, path_stem):
+    # Parquet when an engine is installed, pickle otherwise
+    try:
+        df.to_parquet("{}.parquet".format(path_stem), index=False)
+        stale_path = "{}.pkl".format(path_stem)
+    except ImportError:
+        df.to_pickle("{}.pkl".format(path_stem))
+        stale_path = "{}.parquet".format(path_stem)
+    if os.path.exists(stale_path):
+        os.remove(stale_path)
+
+
+def _read_frame(path_stem):
+    import pandas as pd
+    if os.path.exists("{}.parquet".format(path_stem)):
+        return pd.read_parquet("{}.parquet".format(path_stem))
+    if os.path.exists("{}.pkl".format(path_stem)):
+        return pd.read_pickle("{}.pkl".format(path_stem))
+    return None
+
+
+class _HistoryStore:
+    key_cols = ["序號", "W", "操作關鍵字", "標題", "操作網址", "搜尋結果頁"]
+
+    def __init__(self, history_dir):
+        # days/<result file>: one day's summed rows
+        # state: every day side by side, what concat reports
+        # manifest.json: size and mtime of each result file already taken in
+        self.history_dir = history_dir
+        self.day_dir = os.path.join(history_dir, "days")
+        self.manifest_path = os.path.join(history_dir, "manifest.json")
+        if not os.path.exists(self.day_dir):
+            os.makedirs(self.day_dir)
+        self.manifest = {}
+        if os.path.exists(self.manifest_path):
+            with open(self.manifest_path, "r", encoding="utf-8") as load:
+                self.manifest = json.load(load)
+        self._state = None
+
+    def _save_manifest(self):
+        tmp_path = "{}.tmp".format(self.manifest_path)
+        with open(tmp_path, "w", encoding="utf-8") as save:
+            json.dump(self.manifest, save, ensure_ascii=False)
+        os.replace(tmp_path, self.manifest_path)
+
+    def state(self):
+        import pandas as pd
+        if self._state is None:
+            self._state = _read_frame(os.path.join(self.history_dir, "state"))
+            if self._state is None:
+                self._state = pd.DataFrame(columns=self.key_cols)
+        return self._state
+
+    def _merge(self, state, day):
+        # Outer join on the keys, summing any day column both sides have
+        state = state.set_index(self.key_cols)
+        day = day.set_index(self.key_cols)
+        merged = state.add(day, fill_value=0).fillna(0)
+        merged = merged[sorted(merged.columns)]
+        return merged.reset_index()
+
+    def ingest(self, csv_path):
+        import pandas as pd
+        name = os.path.splitext(os.path.basename(csv_path))[0]
+        stat = os.stat(csv_path)
+        stamp = [stat.st_size, stat.st_mtime]
+        if self.manifest.get(name) == stamp:
+            return False
+        # A result file without its header is a day which never finished
+        with open(csv_path, "r", encoding="utf-8-sig") as check:
+            if check.read(3) != "序號,":
+                return False
+        df = pd.read_csv(csv_path, encoding="utf-8-sig")
+        day = df.groupby(self.key_cols).sum(numeric_only=True).reset_index()
+        _write_frame(day, os.path.join(self.day_dir, name))
+        if name in self.manifest:
+            # The file changed after it was taken in, rebuild from every day
+            state = pd.DataFrame(columns=self.key_cols)
+            for other in sorted(self.manifest):
+                if other != name:
+                    state = self._merge(state, _read_frame(os.path.join(self.day_dir, other)))
+            self._state = self._merge(state, day)
+        else:
+            self._state = self._merge(self.state(), day)
+        _write_frame(self._state, os.path.join(self.history_dir, "state"))
+        self.manifest[name] = stamp
+        self._save_manifest()
+        return True
+
+    def aggregate(self):
+        return self.state().copy()
+
+
+def _raise_exit(signum, frame):
+    sys.exit(128 + signum)
+
+
+def _class_xpath(name):
+    # Same as BeautifulSoup find_all(class_=name) on a multi-valued class
+    return ".//*[contains(concat(' ', normalize-space(@class), ' '), ' {} ')]".format(name)
+
+
+def _anchor_title(anchor):
+    # Same as str(tag.string) on the prettified page: only a text-only anchor has a title
+    text = anchor.text if len(anchor) == 0 else None
+    return re.sub(r"\s*\.*\n\s*", "", str(text)).strip()
+
+
+def _serialize_html(root):
+    from lxml import etree
+    return etree.tostring(root.getroottree(), method="html", encoding="unicode")
+
+
+def _file_digest(path):
+    digest = hashlib.sha1()
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(1 << 20), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def _first_numbered_row(raw_sheet, start):
+    # Index of the first row at or after start whose first cell is 1
+    first_col = raw_sheet[raw_sheet.columns[0]].iloc[start:]
+    return first_col.index[first_col.values == 1][0]
+
+
+def _header_names(header_row):
+    import pandas as pd
+    # Column names the way read_excel would have made them from this row
+    names = []
+    seen = {}
+    for i, value in enumerate(header_row):
+        name = "Unnamed: {}".format(i) if pd.isna(value) else str(value)
+        if name in seen:
+            seen[name] += 1
+            name = "{}.{}".format(name, seen[name])
+        else:
+            seen[name] = 0
+        names.append(name.replace("\n", ""))
+    return names
+
+
 def isRational(txt):
     try:
         float(txt)
@@ -42,63 +1019,118 @@ def isRational(txt):
 
 
 class G_search:
-    def __init__(self):
-        self.config = _load_config()
-        self.project_list = self.get_project()
+    def __init__(self, config=None, replay=None, projects=None):
+        self.config = config or _load_config()
+        # Fixture directory or stand-in server url to replay instead of Google
+        self.replay = replay
+        # Match against today's cached pages only, nothing is fetched
+        self.cache_only = False
+        self.project_list = self.get_project(projects)
         self.page_dict = self.Google_page()
         self.date_str = datetime.today().strftime("%Y%m%d")
         self.home_path = str(Path.home()).replace("\\", "/")
-        self.chrome_opt = self.selenium_setting()
+        self.journal = None
+        self.runs = []
+        self.metrics = _Metrics()
+        # Set up by process, the other commands never fetch
+        self.egress_list = []
+        self.locale = "zh-TW"
+        # Set up by process, opening it already expires old entries
+        self.serp_cache = None
+        self.pipeline = None
+        # Shared by every project so css/js seen anywhere is stored once
+        self.frame_store = _FrameStore(
+            "./store/objects",
+            min_blob=int(self.config["Frame_store"]["min_blob"]),
+            enabled=self.config.getboolean("Frame_store", "enable")
+        )
+        # Separate browsers for rendering saved frames
+        self.shot_pool = _DriverPool(
+            self.config, self.selenium_setting,
+            size=int(self.config["Screenshot"]["workers"]),
+            max_uses=int(self.config["Driver_pool"]["max_uses"]),
+            metrics=self.metrics
+        )
 
-    def get_project(self):
+    def get_project(self, projects=None):
         excel_dir = "./excel"
         if not os.path.exists(excel_dir):
             os.makedirs(excel_dir)
         project = [os.path.splitext(filename)[0] for filename in os.listdir(excel_dir)]
+        if projects:
+            missing = [p for p in projects if p not in project]
+            if missing:
+                sys.exit("找不到專案: {}".format(", ".join(missing)))
+            project = [p for p in project if p in projects]
+        # The project directories are made by whatever first writes into them
         print("Get project: {}\n".format(", ".join(project)))
-        for p in project:
-            if not os.path.exists("./project/{}".format(p)):
-                os.makedirs("./project/{}".format(p))
         return project
 
     def get_keyword_and_target(self, project_file):
         project_dir = "./excel"
         project_path = "{}/{}.xlsx".format(project_dir, project_file)
-        all_sheet = pd.ExcelFile(project_path).sheet_names
+        op_dir = "./project/{}/operation".format(self.project_name)
+        if not os.path.exists(op_dir):
+            os.makedirs(op_dir)
+
+        # Parsed lists are kept until the workbook's content changes
+        cache_path = "{}/workbook_cache.json".format(op_dir)
+        stat = os.stat(project_path)
+        cache = None
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as load:
+                cache = json.load(load)
+        if cache is None or [cache["size"], cache["mtime"]] != [stat.st_size, stat.st_mtime]:
+            digest = _file_digest(project_path)
+            if cache is None or cache["sha1"] != digest:
+                target_list, keyword_list = self.read_workbook(project_path)
+                cache = {"target": target_list, "keyword": keyword_list, "sha1": digest}
+            cache["size"], cache["mtime"] = stat.st_size, stat.st_mtime
+            tmp_path = "{}.tmp".format(cache_path)
+            with open(tmp_path, "w", encoding="utf-8") as save:
+                json.dump(cache, save, ensure_ascii=False)
+            os.replace(tmp_path, cache_path)
+
+        import pandas as pd
+        target_path = "{}/{}_{}_target.csv".format(op_dir, self.date_str, self.project_name)
+        if not os.path.exists(target_path):
+            pd.DataFrame(cache["target"], columns=["序號", "標題", "網址"]).to_csv(target_path, index=False, encoding="utf-8-sig")
+        keyword_path = "{}/{}_{}_keyword.csv".format(op_dir, self.date_str, self.project_name)
+        if not os.path.exists(keyword_path):
+            pd.DataFrame(cache["keyword"], columns=["W", "操作目標字"]).to_csv(keyword_path, index=False, encoding="utf-8-sig")
+        return cache["target"], cache["keyword"]
+
+    def read_workbook(self, project_path):
+        import pandas as pd
+        # Each sheet is read once; header rows are found in memory
+        workbook = pd.ExcelFile(project_path)
+        all_sheet = workbook.sheet_names
         attach_1 = [s for s in all_sheet if "附件一" in s][0]
         attach_2 = [s for s in all_sheet if "附件二" in s][0]
 
         ## Target
-        pre_target = pd.read_excel(project_path, sheet_name=attach_1, skiprows=1)
-        # Find the first row
-        row_target = pre_target.loc[pre_target[pre_target.columns[0]] == 1].index.values.astype(int)[0]
+        raw_target = workbook.parse(attach_1, header=None)
+        # Find the first row, below the title and note rows
+        row_target = _first_numbered_row(raw_target, 2)
         # Load dataframe
         target_cols = ["序號", "標題", "網址"]
-        sheet_target = pd.read_excel(project_path, sheet_name=attach_1, skiprows=row_target + 1, usecols=range(3))
-        sheet_target.rename(columns=dict(zip(sheet_target.columns, target_cols)), inplace=True)
+        sheet_target = raw_target.iloc[row_target:, :3].copy()
+        sheet_target.columns = target_cols
         sheet_target = sheet_target[sheet_target["序號"].apply(lambda x: isRational(x))].reset_index(drop=True).dropna(subset=["序號"])
         sheet_target["序號"] = sheet_target["序號"].values.astype(int)
 
-        op_dir = "./project/{}/operation".format(self.project_name)
-        if not os.path.exists(op_dir):
-            os.makedirs(op_dir)
-        target_path = "{}/{}_{}_target.csv".format(op_dir, self.date_str, self.project_name)
-        sheet_target[["序號", "標題", "網址"]].to_csv(target_path, index=False, encoding="utf-8-sig")
-
         ## Keyword
-        pre_sheet = pd.read_excel(project_path, sheet_name=attach_2)
-        # Find the first row
-        row_header = pre_sheet.loc[pre_sheet[pre_sheet.columns[0]] == 1].index.values.astype(int)[0]
+        raw_sheet = workbook.parse(attach_2, header=None)
+        # Find the first row, the header is the row above it
+        row_header = _first_numbered_row(raw_sheet, 1)
         # Load dataframe
-        op_sheet = pd.read_excel(project_path, sheet_name=attach_2, skiprows=row_header).fillna(method="ffill")
+        op_sheet = raw_sheet.iloc[row_header:].reset_index(drop=True).infer_objects()
         # Replace "\n" in headers
-        op_sheet.columns = op_sheet.columns.str.replace("\n", "")
+        op_sheet.columns = _header_names(raw_sheet.iloc[row_header - 1])
+        op_sheet = op_sheet.fillna(method="ffill")
         # Change first column header to "W"
         op_sheet.columns.values[0] = "W"
 
-        keyword_path = "{}/{}_{}_keyword.csv".format(op_dir, self.date_str, self.project_name)
-        op_sheet[["W", "操作目標字"]].to_csv(keyword_path, index=False, encoding="utf-8-sig")
-
         return sheet_target[["序號", "標題", "網址"]].values.tolist(), \
                 op_sheet[["W", "操作目標字"]].values.tolist()
 
@@ -107,110 +1139,171 @@ class G_search:
         page_parameter = [0, 10, 20]
         return dict(zip(page_key, page_parameter))
 
-    def html_preprocess(self, key_word, count):
-        url = "http://www.google.com/search?q={}&hl=zh-TW&ie=utf-8&oe=utf-8&start={}".format(key_word, count)
+    def html_preprocess(self, key_word, count, egress, num=None):
+        url = "http://www.google.com/search?q={}&hl={}&ie=utf-8&oe=utf-8&start={}".format(key_word, self.locale, count)
+        if num is not None:
+            url = "{}&num={}".format(url, num)
+        if self.serp_cache is None:
+            return self.fetch_page(url, egress, key_word)
+        # One fetch per query a day, whichever project asks first
+        cache_key = (self.date_str, key_word, count, num, self.locale)
+        with self.serp_cache.lock(cache_key):
+            cached = self.serp_cache.get(cache_key)
+            if cached is None and self.cache_only:
+                raise _CacheMiss("{} start={}".format(key_word, count))
+            if cached is not None:
+                import lxml.html
+                print("快取: {} start={}".format(key_word, count))
+                self.metrics.count("cache_hits", self.project_name)
+                with self.metrics.stage("cache_load", project=self.project_name, keyword=key_word):
+                    return lxml.html.document_fromstring(cached)
+            root = self.fetch_page(url, egress, key_word)
+            self.serp_cache.put(cache_key, _serialize_html(root))
+            return root
 
-        # requests was banned
-        # res = self.rs.get(url, timeout=9)
-        # res_text = res.text
-        # soup = BS(res_text, "lxml")
-
-        driver = webdriver.Chrome(
-            executable_path=self.config["Chrome_Canary"]["CHROMEDRIVER_PATH"],
-            options=self.chrome_opt
-        )
-        driver.get(url)
-        time.sleep(random.uniform(1, 2))
-        res_text = driver.page_source
-        soup = BS(res_text, "lxml")
-        driver.quit()
-
-        # Set "utf-8"
-        soup.find("meta")["charset"] = "utf-8"
-
-        # debug
-        # debug_soup = soup.prettify()
-        # debug_html_dir = "./project/{}/debug".format(self.project_name)
-        # if not os.path.exists(debug_html_dir):
-        #     os.makedirs(debug_html_dir)
-        # with open("{}/res_debug_{}.html".format(debug_html_dir, self.date_str), "w", encoding="utf-8") as save:
-        #     save.write(debug_soup)
-
-        if soup.find(id="recaptcha"):
-            recapt_continue = soup.find("input", {"name": "continue"})["value"]
-            recapt_q = soup.find("input", {"name": "q"})["value"]
-            recapt_url = "https://www.google.com/sorry/index?continue={}&q={}".format(recapt_continue, recapt_q)
-            print(recapt_url)
-            print("被Google ban了QQ")
-            print("請換IP或手動解reCAPTCHA(手解不一定有效)或等到Google自己解除\n")
-            sys.exit()
+    def open_serp_cache(self):
+        # Replayed pages are already local, caching them would only hide the work
+        if self.config.getboolean("Serp_cache", "enable") and self.replay is None:
+            self.serp_cache = _SerpCache(
+                "./cache/serp",
+                ttl=float(self.config["Serp_cache"]["ttl"]),
+                max_bytes=int(float(self.config["Serp_cache"]["max_mb"]) * 1024 * 1024)
+            )
 
-        # Set footcnt as visible
-        soup.find(id="footcnt")["style"] = "position:relative;visibility:visible"
+    def fetch_page(self, url, egress, key_word=None):
+        while True:
+            sleep_time = egress.pacer.acquire()
+            if sleep_time > 0:
+                print("[{}] Sleep for {:.1f} secs.".format(egress.name, sleep_time))
+                self.metrics.record("sleep", sleep_time, egress=egress.name)
 
-        prettified = soup.prettify()
+            fetch_start = time.perf_counter()
+            try:
+                res_text = egress.fetcher.fetch(url)
+            finally:
+                egress.pacer.release()
+            latency = time.perf_counter() - fetch_start
+            self.metrics.record("fetch", latency, project=self.project_name, keyword=key_word, egress=egress.name)
+            self.metrics.count("pages", self.project_name)
+            try:
+                with self.metrics.stage("parse", project=self.project_name, keyword=key_word):
+                    root = self.clean_page(res_text)
+            except _GoogleBanned as e:
+                print(e.recapt_url)
+                print("被Google ban了QQ")
+                self.metrics.count("bans", self.project_name)
+                pause = egress.pacer.banned()
+                if pause is None:
+                    print("請換IP或手動解reCAPTCHA(手解不一定有效)或等到Google自己解除\n")
+                    raise
+                # The journal is already at this keyword, so waiting here resumes from the checkpoint
+                print("[{}] 暫停{:.0f}分鐘後重試同一頁\n".format(egress.name, pause / 60))
+                time.sleep(pause)
+                continue
+            complete = root.get_element_by_id("rso", None) is not None and root.get_element_by_id("footcnt", None) is not None
+            egress.pacer.observe(latency, complete)
+            return root
 
+    def clean_page(self, res_text):
+        import lxml.html
+        from lxml import etree
         # Save origin html with utf-8 encoding
-        origin_html_dir = "./project/{}/origin".format(self.project_name)
-        if not os.path.exists(origin_html_dir):
-            os.makedirs(origin_html_dir)
-        with open("{}/res_origin_{}.html".format(origin_html_dir, self.date_str), "w", encoding="utf-8") as save:
-            save.write(prettified)
+        dump_html = self.config.getboolean("Debug", "dump_html")
+        if dump_html:
+            origin_html_dir = "./project/{}/origin".format(self.project_name)
+            if not os.path.exists(origin_html_dir):
+                os.makedirs(origin_html_dir)
+            with open("{}/res_origin_{}.html".format(origin_html_dir, self.date_str), "w", encoding="utf-8") as save:
+                save.write(res_text)
 
         # Replace url with prefix from original src
         src_sub = {"//ssl.gstatic.com": "http://ssl.gstatic.com", \
                    "/images/nav_logo242.png": "http://www.google.com.tw/images/nav_logo242.png"}
         src_sub = dict((re.escape(k), v) for k, v in src_sub.items())
         pattern = re.compile("|".join(src_sub.keys()))
-        prettified = pattern.sub(lambda m: src_sub[re.escape(m.group(0))], prettified)
-
-        soup_p = BS(prettified, "lxml")
-        # Drop ads on top and bottom
-        for ad in soup_p.find_all(class_="C4eCVc"):
-            ad.decompose()
-        # Drop ads on right column
-        for right_col in soup_p.find_all(class_="cu-container"):
-            right_col.decompose()
-        # Remove the privacy check
-        for check in soup_p.find_all(id="taw"):
-            check.decompose()
-        # Remove the privacy options
-        for check in soup_p.find_all(role="dialog"):
-            check.decompose()
-        # Remove Chrome version check
-        for version_check in soup_p.find_all(class_="gb_Fd gb_Zc"):
-            version_check.decompose()
-        # Add Google map image src
-        for g_map in soup_p.find_all(id="lu_map"):
-            g_map["src"] = "http://www.google.com.tw{}".format(g_map["src"])
-        # Add url prefix to img src
-        add_prefix = lambda src: "http://www.google.com.tw{}".format(src)
-        src_to_fix = [soup_p.find(itemprop="image")["content"], \
-                      soup_p.find(class_="logo").find("a").find("img")["src"]]
-        src_fixed = list(map(add_prefix, src_to_fix))
-        soup_p.find(itemprop="image")["content"], \
-            soup_p.find(class_="logo").find("a").find("img")["src"] = src_fixed
-        # Remove the background color of Google Apps
-        # style = soup_p.find("style", text=re.compile("gb_Dd")).text
-        # style_fix = soup_p.find("style", text=re.compile("gb_Dd")).string.replace(";background-color:#4d90fe", "")
-        # soup_p.find("style", text=re.compile("gb_Dd")).string = style_fix
+        res_text = pattern.sub(lambda m: src_sub[re.escape(m.group(0))], res_text)
+
+        root = lxml.html.document_fromstring(res_text)
+
+        if root.get_element_by_id("recaptcha", None) is not None:
+            recapt_continue = root.xpath("//input[@name='continue']/@value")[0]
+            recapt_q = root.xpath("//input[@name='q']/@value")[0]
+            recapt_url = "https://www.google.com/sorry/index?continue={}&q={}".format(recapt_continue, recapt_q)
+            raise _GoogleBanned(recapt_url)
+
+        add_prefix = lambda src: src if src.startswith("http") else "http://www.google.com.tw{}".format(src)
+        meta_fixed = image_fixed = logo_fixed = False
+        drop = []
+        # Everything inside a dropped element, which the fixes below must not pick
+        dropped = set()
+        # Walk the document once for every removal and src fix
+        for el in root.iter(etree.Element):
+            # Set "utf-8", on the first meta of the whole page as before the drops
+            if el.tag == "meta" and not meta_fixed:
+                el.set("charset", "utf-8")
+                meta_fixed = True
+            if el.getparent() in dropped:
+                dropped.add(el)
+                continue
+            el_class = el.get("class") or ""
+            el_id = el.get("id")
+            classes = el_class.split()
+            # Drop ads on top and bottom / ads on right column / the privacy check /
+            # the privacy options / Chrome version check
+            if "C4eCVc" in classes or "cu-container" in classes or el_id == "taw" \
+                    or el.get("role") == "dialog" or el_class == "gb_Fd gb_Zc":
+                drop.append(el)
+                dropped.add(el)
+                continue
+            # Set footcnt as visible
+            if el_id == "footcnt":
+                el.set("style", "position:relative;visibility:visible")
+            # Add Google map image src
+            elif el_id == "lu_map" and el.get("src"):
+                el.set("src", add_prefix(el.get("src")))
+            # Add url prefix to img src
+            if el.get("itemprop") == "image" and not image_fixed:
+                el.set("content", add_prefix(el.get("content", "")))
+                image_fixed = True
+            if "logo" in classes and not logo_fixed:
+                logo_fixed = True
+                logo_img = el.find(".//a//img")
+                if logo_img is not None and logo_img.get("src"):
+                    logo_img.set("src", add_prefix(logo_img.get("src")))
+        for el in drop:
+            el.drop_tree()
+
         # Save no-ads html
-        no_ads_dir = "./project/{}/no_ads".format(self.project_name)
-        if not os.path.exists(no_ads_dir):
-            os.makedirs(no_ads_dir)
-        with open("{}/no-ads_{}.html".format(no_ads_dir, self.date_str), "w", encoding="utf-8") as save:
-            save.write(soup_p.prettify())
-        return soup_p.prettify()
+        if dump_html:
+            no_ads_dir = "./project/{}/no_ads".format(self.project_name)
+            if not os.path.exists(no_ads_dir):
+                os.makedirs(no_ads_dir)
+            with open("{}/no-ads_{}.html".format(no_ads_dir, self.date_str), "w", encoding="utf-8") as save:
+                save.write(_serialize_html(root))
+        return root
+
+    def result_file(self, staged=None):
+        result_path = "./project/{0}/result/result_{0}_{1}.csv".format(self.project_name, self.date_str)
+        if self.cache_only if staged is None else staged:
+            # Re-matched rows replace today's result only once every page was in the cache;
+            # not ending in .csv keeps concat from reading it
+            return "{}.match".format(result_path)
+        return result_path
 
     def process_check(self):
-        result_dir = "./project/{}/result".format(self.project_name)
-        if not os.path.exists(result_dir):
-            os.makedirs(result_dir)
-        result_path = "{}/result_{}_{}.csv".format(result_dir, self.project_name, self.date_str)
+        result_path = self.result_file()
         if os.path.exists(result_path):
             with open(result_path, "r", encoding="utf-8-sig") as check:
-                if check.read()[:3] == "序號,":
+                if check.read(3) == "序號,":
+                    return None, None
+            checkpoint = _ResultJournal.read_checkpoint(result_path)
+            if checkpoint is not None:
+                if checkpoint.get("done"):
                     return None, None
+                if "next" in checkpoint:
+                    return checkpoint["next"], 0
+                return int(float(checkpoint["keyword"])) - 1, int(checkpoint["target"])
+            # No checkpoint beside the result, scan it for the last row
             with open(result_path, "r", encoding="utf-8-sig") as check:
                 pairs = [line.strip().split(",") for line in check.readlines()]
                 url_index = [pair[0] for pair in pairs]
@@ -219,53 +1312,94 @@ class G_search:
         else:
             return 0, 0
 
-    def search_html(self, html, key_word, page_x, page_count):
+    def search_html(self, root, key_word, page_x, page_count, page_size=None):
+        with self.metrics.stage("match", project=self.project_name, keyword=key_word[1]):
+            self.match_html(root, key_word, page_x, page_count, page_size)
+        if self.found == 1:
+            self.metrics.count("found_pages", self.project_name)
+            if self.pipeline is not None:
+                # The next fetch goes ahead while the page is written and shot
+                self.pipeline.write(self.project_name, self.keep_page, root, key_word, page_count)
+                return None
+            with self.metrics.stage("frame_write", project=self.project_name, keyword=key_word[1]):
+                return self.save_frame(root, key_word, page_count)
+
+    def keep_page(self, root, key_word, page_count):
+        with self.metrics.stage("frame_write", project=self.project_name, keyword=key_word[1]):
+            frame_path = self.save_frame(root, key_word, page_count)
+        self.pipeline.shoot(self.project_name, self.screenshot, frame_path, key_word, page_count)
+
+    def match_html(self, root, key_word, page_x, page_count, page_size=None):
         self.found = 0
-        soup_no_ad = BS(html, "lxml")
-        title_slice = int(self.config["Title_part"]["slice"])
-        url_pat = re.compile("(\/([\d\-\/]*))-.*")
-        for target in self.target_list[self.url_last:]:
-            rank = 1
-            self.search = 0
-            for s_res in soup_no_ad.find(id="rso").find_all(class_="g"):
-                title_part = re.sub("\s*\.*\\n\s*", "", str(s_res.a.string))
-                if unquote(target[2]) in unquote(s_res.a["href"]) and url_pat.sub("\\1", unquote(target[2])) == url_pat.sub("\\1", unquote(s_res.a["href"])) \
-                    or (target[1][:title_slice] == title_part[:title_slice] and urlparse(unquote(target[2])).hostname == urlparse(unquote(s_res.a["href"])).hostname):
-                    s_res.find(class_="tF2Cxc")["style"] = "border-width:2px; border-style:solid; border-color:red; padding:1px;"
-                    message = "關鍵字: {} {}\t在 第{}頁 第{}個 找到\n{}".format(\
-                        key_word[0], key_word[1], page_count, rank, target[2])
-                    print(message)
-                    self.found = 1
-                    self.search = 1
-                    result_row = "{},{},\"{}\",\"{}\",\"{}\",{}, {}\n".format(\
-                        target[0], key_word[0], key_word[1], target[1], target[2], page_x, 1)
-                    self.search_result(result_row)
+        rso = root.get_element_by_id("rso", None)
+        s_results = rso.xpath(_class_xpath("g")) if rso is not None else []
+        if page_size:
+            # One page holding several: ranks past the last page label are dropped
+            s_results = s_results[:page_size * len(self.page_dict)]
+        # Ranks of every result matched by each target position
+        hits = {}
+        rank = 1
+        for s_res in s_results:
+            anchor = s_res.find(".//a")
+            if anchor is None or anchor.get("href") is None:
                 rank += 1
-            if self.search == 0:
+                continue
+            matched = [pos for pos in self.target_index.match(anchor.get("href"), _anchor_title(anchor)) if pos >= self.url_last]
+            if matched:
+                for box in s_res.xpath(_class_xpath("tF2Cxc"))[:1]:
+                    box.set("style", "border-width:2px; border-style:solid; border-color:red; padding:1px;")
+            for pos in matched:
+                hits.setdefault(pos, []).append(rank)
+            rank += 1
+        for pos in range(self.url_last, len(self.target_list)):
+            target = self.target_list[pos]
+            for rank in hits.get(pos, []):
+                hit_page_x, hit_page_count = page_x, page_count
+                if page_size:
+                    # Split back into the page the result would have been on
+                    hit_page_count = (rank - 1) // page_size + 1
+                    hit_page_x = list(self.page_dict)[hit_page_count - 1]
+                    rank = (rank - 1) % page_size + 1
+                message = "關鍵字: {} {}\t在 第{}頁 第{}個 找到\n{}".format(\
+                    key_word[0], key_word[1], hit_page_count, rank, target[2])
+                print(message)
+                self.found = 1
+                result_row = "{},{},\"{}\",\"{}\",\"{}\",{}, {}\n".format(\
+                    target[0], key_word[0], key_word[1], target[1], target[2], hit_page_x, 1)
+                self.search_result(result_row, key_word, target)
+            if pos not in hits:
                 result_row = "{},{},\"not found and will be remove\",,,,\n".format(target[0], key_word[0])
-                self.search_result(result_row)
+                self.search_result(result_row, key_word, target)
+        self.found_targets = set(hits)
         self.url_last = 0
 
+    def save_frame(self, root, key_word, page_count):
         frame_dir = "./project/{}/frame/{}".format(self.project_name, self.date_str)
-        if self.found == 1:
-            if not os.path.exists(frame_dir):
-                os.makedirs(frame_dir)
-            save_path = "{}/W{}_{}_{}_P{}.html".format(frame_dir, key_word[0], key_word[1], self.date_str, page_count)
-            with open(save_path, "w", encoding="utf-8") as save:
-                save.write(soup_no_ad.prettify())
-            return os.path.abspath(save_path).replace("\\", "/")
-
-    def search_result(self, result_content):
+        if not os.path.exists(frame_dir):
+            os.makedirs(frame_dir)
+        path_stem = "{}/W{}_{}_{}_P{}".format(frame_dir, key_word[0], key_word[1], self.date_str, page_count)
+        save_path = self.frame_store.save(root, path_stem)
+        return os.path.abspath(save_path).replace("\\", "/")
+
+    def search_result(self, result_content, key_word, target):
+        self.journal.write(result_content, self.keyword_index)
+
+    def open_journal(self):
         result_dir = "./project/{}/result".format(self.project_name)
         if not os.path.exists(result_dir):
             os.makedirs(result_dir)
-        result_path = "{}/result_{}_{}.csv".format(result_dir, self.project_name, self.date_str)
-        with open(result_path, "a", encoding="utf-8-sig") as result:
-            result.write("{}".format(result_content))
+        self.journal = _ResultJournal(
+            self.result_file(),
+            flush_rows=int(self.config["Result_buffer"]["rows"]),
+            flush_secs=float(self.config["Result_buffer"]["seconds"]),
+            metrics=self.metrics,
+            submit=None if self.pipeline is None else lambda fn, *args: self.pipeline.write(self.project_name, fn, *args),
+            next_keyword=self.keyword_last
+        )
 
     def result_end(self):
-        result_dir = "./project/{}/result".format(self.project_name)
-        result_path = "{}/result_{}_{}.csv".format(result_dir, self.project_name, self.date_str)
+        import pandas as pd
+        result_path = self.result_file()
         # if os.path.exists(result_path):
         df = pd.read_csv(result_path, encoding="utf-8-sig", header=None, engine="python")
         res_cols = ["序號", "W", "操作關鍵字", "標題", "操作網址", "搜尋結果頁", datetime.today().strftime("%Y/%m/%d")]
@@ -289,9 +1423,11 @@ class G_search:
             for x in files:
                 if x.endswith(".csv"):
                     csv_files.append(os.path.join(dirpath, x).replace("\\", "/"))
-        dfs = [pd.read_csv(f, encoding="utf-8-sig", engine="python") for f in csv_files]
-        df = pd.concat(dfs, sort=False, ignore_index=True)
-        df = df.groupby(["序號", "W", "操作關鍵字", "標題", "操作網址", "搜尋結果頁"]).sum().reset_index()
+        # Only days not seen before (or changed since) are read
+        history = _HistoryStore("./project/{}/history".format(self.project_name))
+        for f in sorted(csv_files):
+            history.ingest(f)
+        df = history.aggregate()
         df.iloc[:, 6:] = df.iloc[:, 6:].values.astype(int)
         # Sort the concatenated dataframe
         df["page"] = df["搜尋結果頁"].map(self.page_dict)
@@ -303,6 +1439,60 @@ class G_search:
         concat_path = "{}/concat_{}_{}.csv".format(concat_dir, self.project_name, self.date_str)
         df.to_csv(concat_path, index=False, encoding="utf-8-sig")
 
+    def finalize(self):
+        # Every keyword is done, result_end may not have run yet
+        result_path = self.result_file()
+        with open(result_path, "r", encoding="utf-8-sig") as check:
+            headed = check.read(3) == "序號,"
+        if not headed:
+            self.result_end()
+        if self.cache_only:
+            self.take_match()
+
+    def aggregate(self):
+        if os.path.exists(self.result_file()):
+            if self.process_check()[0] is None:
+                self.finalize()
+            else:
+                print("{} 今天尚未完成 只合併之前的結果".format(self.project_name))
+        self.concat()
+        print("--{} 合併完成--\n".format(self.project_name))
+
+    def take_match(self):
+        # The staged result is complete, it becomes today's result
+        staged_path = self.result_file(staged=True)
+        result_path = self.result_file(staged=False)
+        os.replace(staged_path, result_path)
+        for path in (_ResultJournal.checkpoint_of(staged_path), _ResultJournal.checkpoint_of(result_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def drop_match(self):
+        staged_path = self.result_file(staged=True)
+        for path in (staged_path, _ResultJournal.checkpoint_of(staged_path)):
+            if os.path.exists(path):
+                os.remove(path)
+
+    def status(self):
+        cache_path = "./project/{}/operation/workbook_cache.json".format(self.project_name)
+        keyword_total = "?"
+        if os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as load:
+                keyword_total = len(json.load(load)["keyword"])
+        result_path = "./project/{0}/result/result_{0}_{1}.csv".format(self.project_name, self.date_str)
+        keyword_last, url_last = self.process_check()
+        if keyword_last is None:
+            progress = "已完成"
+        elif not os.path.exists(result_path):
+            progress = "尚未開始"
+        else:
+            progress = "第{} / {}個關鍵字 第{}個目標網址".format(keyword_last + 1, keyword_total, url_last)
+        counts = []
+        for sub_dir in ("frame", "screenshot"):
+            day_dir = "./project/{}/{}/{}".format(self.project_name, sub_dir, self.date_str)
+            counts.append(len(os.listdir(day_dir)) if os.path.exists(day_dir) else 0)
+        return "{}\t{}\thtml: {} screenshot: {}".format(self.project_name, progress, *counts)
+
     def remove_temp_dir(self):
         dir_list = ["no_ads", "origin"]
         for rm_dir in dir_list:
@@ -311,6 +1501,8 @@ class G_search:
                 shutil.rmtree(rm_path)
 
     def check_screenshot(self):
+        if self.replay is not None:
+            return
         frame_dir = "./project/{}/frame/{}".format(self.project_name, self.date_str)
         screenshot_dir = "./project/{}/screenshot/{}".format(self.project_name, self.date_str)
         frame_num = len(os.listdir(frame_dir))
@@ -330,32 +1522,44 @@ class G_search:
         frame_files = []
         for dirpath, subdirs, files in os.walk(frame_dir):
             for x in files:
-                if x.endswith(".html"):
-                    frame_files.append([os.path.join(dirpath, x).replace("\\", "/"), x[:-5]])
+                if self.frame_store.is_frame(x):
+                    frame_files.append(os.path.join(dirpath, x).replace("\\", "/"))
+        self.screenshot_batch(frame_files, screenshot_dir)
 
-        screenshot_files = []
-        for dirpath, subdirs, files in os.walk(screenshot_dir):
-            for x in files:
-                if x.endswith(".png"):
-                    screenshot_files.append(x[:-4])
-
-        for file in frame_files:
-            if not file[1] in screenshot_files:
-                driver = webdriver.Chrome(
-                    executable_path=self.config["Chrome_Canary"]["CHROMEDRIVER_PATH"],
-                    options=self.chrome_opt
-                )
-                driver.get("file:///{}".format(file[0]))
-                width  = driver.execute_script("return Math.max(document.body.scrollWidth, document.body.offsetWidth, document.documentElement.clientWidth, document.documentElement.scrollWidth, document.documentElement.offsetWidth);")
-                height = driver.execute_script("return Math.max(document.body.scrollHeight, document.body.offsetHeight, document.documentElement.clientHeight, document.documentElement.scrollHeight, document.documentElement.offsetHeight);")
-                driver.set_window_size(width, height)
-                print("screenshot: {}.png".format(file[1]))
-                save_path = "{}/{}.png".format(screenshot_dir, file[1])
-                driver.save_screenshot(save_path)
-                driver.quit()
+    def screenshot_batch(self, html_paths, screenshot_dir):
+        if not os.path.exists(screenshot_dir):
+            os.makedirs(screenshot_dir)
+        # Skip frames which already have a screenshot
+        jobs = []
+        for html_path in html_paths:
+            save_path = "{}/{}.png".format(screenshot_dir, self.frame_store.stem(html_path))
+            if not os.path.exists(save_path):
+                jobs.append((os.path.abspath(html_path).replace("\\", "/"), save_path))
+        if not jobs:
+            return 0
+
+        def shoot(job):
+            with self.metrics.stage("screenshot", project=self.project_name):
+                with self.shot_pool.borrow() as driver:
+                    self.full_page_shot(driver, *job)
+            print("screenshot: {}".format(os.path.basename(job[1])))
+
+        batch_start = time.perf_counter()
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.shot_pool.size) as executor:
+            for future in as_completed([executor.submit(shoot, job) for job in jobs]):
+                try:
+                    future.result()
+                    done += 1
+                except Exception as e:
+                    print("截圖失敗: {}".format(e))
+        elapsed = time.perf_counter() - batch_start
+        print("截圖 {} / {} 張 花費 {:.1f} 秒 ({:.2f} 頁/秒)".format(done, len(jobs), elapsed, done / elapsed if elapsed else 0))
+        return done
 
     def selenium_setting(self):
         # Selenium setting
+        from selenium.webdriver.chrome.options import Options
         chrome_opt = Options()
         # chrome_opt.set_headless(headless=True)
         chrome_opt.headless = True
@@ -376,62 +1580,454 @@ class G_search:
         return chrome_opt
 
     def screenshot(self, html_path, key_word, page_count):
+        if self.replay is not None:
+            return
         screenshot_dir = "./project/{}/screenshot/{}".format(self.project_name, self.date_str)
         if not os.path.exists(screenshot_dir):
             os.makedirs(screenshot_dir)
 
-        driver = webdriver.Chrome(
-            executable_path=self.config["Chrome_Canary"]["CHROMEDRIVER_PATH"],
-            options=self.chrome_opt
-        )
-        driver.get("file:///{}".format(html_path))
-        width  = driver.execute_script("return Math.max(document.body.scrollWidth, document.body.offsetWidth, document.documentElement.clientWidth, document.documentElement.scrollWidth, document.documentElement.offsetWidth);")
-        height = driver.execute_script("return Math.max(document.body.scrollHeight, document.body.offsetHeight, document.documentElement.clientHeight, document.documentElement.scrollHeight, document.documentElement.offsetHeight);")
-        driver.set_window_size(width, height)
         save_path = "{}/W{}_{}_{}_P{}.png".format(screenshot_dir, key_word[0], key_word[1], self.date_str, page_count)
-        driver.save_screenshot(save_path)
-        driver.quit()
+        if os.path.exists(save_path) and os.path.getmtime(save_path) >= os.path.getmtime(html_path):
+            # Taken after the frame was last written, nothing new to render
+            return
+        with self.metrics.stage("screenshot", project=self.project_name, keyword=key_word[1]):
+            with self.shot_pool.borrow() as driver:
+                self.full_page_shot(driver, html_path, save_path)
 
-    def process(self):
-        start_time = datetime.now().replace(microsecond=0)
+    def full_page_shot(self, driver, html_path, save_path):
+        with self.frame_store.materialized(html_path) as page_path:
+            # A pooled browser keeps the last page's size, and the probe below
+            # counts the viewport, so start from the headless default again
+            driver.set_window_size(800, 600)
+            driver.get("file:///{}".format(page_path))
+            # Probe both sizes in one round trip
+            width, height = driver.execute_script(
+                "var b = document.body, d = document.documentElement;"
+                "return [Math.max(b.scrollWidth, b.offsetWidth, d.clientWidth, d.scrollWidth, d.offsetWidth),"
+                "Math.max(b.scrollHeight, b.offsetHeight, d.clientHeight, d.scrollHeight, d.offsetHeight)];"
+            )
+            driver.set_window_size(width, height)
+            if self.config.getboolean("Screenshot", "crop") and self.highlight_shot(driver, save_path):
+                return
+            driver.save_screenshot(save_path)
 
+    def highlight_shot(self, driver, save_path, margin=16):
+        # Only the box around the results match_html framed in red
+        rect = driver.execute_script(
+            "var boxes = document.querySelectorAll('.tF2Cxc[style*=\"border-color:red\"]');"
+            "if (!boxes.length) return null;"
+            "var l = Infinity, t = Infinity, r = 0, b = 0;"
+            "for (var i = 0; i < boxes.length; i++) {"
+            "var x = boxes[i].getBoundingClientRect();"
+            "l = Math.min(l, x.left); t = Math.min(t, x.top); r = Math.max(r, x.right); b = Math.max(b, x.bottom);}"
+            "return [l + window.scrollX, t + window.scrollY, r - l, b - t];"
+        )
+        if not rect:
+            return False
+        left, top, width, height = rect
+        clip = {
+            "x": max(left - margin, 0),
+            "y": max(top - margin, 0),
+            "width": width + 2 * margin,
+            "height": height + 2 * margin,
+            "scale": 1
+        }
+        shot = driver.execute_cdp_cmd("Page.captureScreenshot", {"format": "png", "clip": clip, "captureBeyondViewport": True})
+        with open(save_path, "wb") as save:
+            save.write(base64.b64decode(shot["data"]))
+        return True
+
+    def egress_profiles(self):
+        if self.replay is not None:
+            # Saved pages need no pacing
+            return [_Egress("replay", _ReplayFetcher(self.replay), _Pacer(0, 0))]
+        if self.cache_only:
+            return [_Egress("cache", _CacheOnlyFetcher(), _Pacer(0, 0))]
         min_sleep = float(self.config["Sleep_time"]["min"])
         max_sleep = float(self.config["Sleep_time"]["max"])
+        pacing = self.config["Pacing"]
+        backend = self.config["Fetcher"]["backend"]
+        sections = [section for section in self.config.sections() if section.startswith("Egress_")]
+        egress_list = []
+        # Without any Egress_ section everything goes out the default way
+        for section in sections or [None]:
+            name = "default"
+            proxy = None
+            user_data_dir = None
+            if section is not None:
+                name = section[len("Egress_"):]
+                proxy = self.config[section].get("proxy")
+                user_data_dir = self.config[section].get("user_data_dir")
+
+            def make_options(proxy=proxy, user_data_dir=user_data_dir):
+                chrome_opt = self.selenium_setting()
+                if proxy:
+                    chrome_opt.add_argument("--proxy-server={}".format(proxy))
+                if user_data_dir:
+                    chrome_opt.add_argument("--user-data-dir={}".format(os.path.abspath(user_data_dir)))
+                return chrome_opt
 
+            driver_pool = _DriverPool(
+                self.config, make_options,
+                # Chrome locks its profile directory, so a profile holds one browser
+                size=1 if user_data_dir else int(self.config["Driver_pool"]["size"]),
+                max_uses=int(self.config["Driver_pool"]["max_uses"]),
+                metrics=self.metrics
+            )
+            fetcher = _SeleniumFetcher(driver_pool)
+            if backend == "http":
+                session = _requests_retry_session(
+                    self.config,
+                    retries=int(self.config["Fetcher"]["retries"]),
+                    backoff_factor=float(self.config["Fetcher"]["backoff"])
+                )
+                if proxy:
+                    session.proxies.update({"http": proxy, "https": proxy})
+                fetcher = _HttpFetcher(
+                    session,
+                    fallback=fetcher,
+                    base_url=self.config["Fetcher"].get("base_url") or None,
+                    max_fallbacks=int(self.config["Fetcher"]["max_fallbacks"])
+                )
+            pacer = _Pacer(
+                min_sleep, max_sleep,
+                # What each egress learned is kept between runs
+                state_path="./pacing/{}.json".format(name),
+                adaptive=pacing.getboolean("adaptive"),
+                step=float(pacing["step"]),
+                backoff=float(pacing["backoff"]),
+                ban_pause=float(pacing["ban_pause"]),
+                max_bans=int(pacing["max_bans"])
+            )
+            egress_list.append(_Egress(name, fetcher, pacer))
+        return egress_list
+
+    def process(self):
+        start_time = datetime.now().replace(microsecond=0)
+        # Let "kill" unwind like Ctrl-C so buffered results get flushed
+        signal.signal(signal.SIGTERM, _raise_exit)
+        if self.config.getboolean("Metrics", "enable"):
+            self.metrics.open("./metrics/metrics_{}.jsonl".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+        self.open_serp_cache()
+        self.egress_list = self.egress_profiles()
+        if self.config.getboolean("Pipeline", "enable"):
+            self.pipeline = _Pipeline(self.shot_pool.size)
+        for egress in self.egress_list:
+            egress.fetcher.warm_up()
+        finished = False
+        try:
+            self.process_projects()
+            finished = True
+        except _GoogleBanned:
+            print("已保存進度 下次執行從中斷處繼續\n")
+            return
+        finally:
+            for run in self.runs:
+                if run.journal is not None:
+                    run.journal.flush()
+            if self.pipeline is not None:
+                # Queued writes always land, queued screenshots only on a normal finish
+                self.pipeline.close(cancel=not finished)
+            for egress in self.egress_list:
+                egress.fetcher.close()
+            self.shot_pool.close()
+            self.metrics.close()
+        print(self.metrics.summary())
+        print("==全部完成 花費時間: {}==".format(str(datetime.now().replace(microsecond=0) - start_time)))
+
+    def process_projects(self):
         for project in self.project_list:
-            self.project_name = project
-            print("--{} 執行--".format(self.project_name))
-            self.keyword_last, self.url_last = self.process_check()
-            self.target_list, self.keyword_list = self.get_keyword_and_target(self.project_name)
-            if self.keyword_last == None:
-                print("--{} 已完成--\n".format(self.project_name))
-                self.concat()
-                self.remove_temp_dir()
-                self.check_screenshot()
-                continue
-            elif self.keyword_last > 0 or self.url_last > 0:
-                print("從第{}個關鍵字 第{}個目標網址 繼續\n".format(self.keyword_last + 1, self.url_last))
-            keyword_count = 1
-            for keyword in self.keyword_list[self.keyword_last:]:
-                for page_key, page_parameter in self.page_dict.items():
-                    self.rs = _requests_retry_session(self.config)
-                    no_ad_html = self.html_preprocess(keyword[1], page_parameter)
-                    if no_ad_html:
-                        page_count = int(page_parameter / 10 + 1)
-                        frame_path = self.search_html(no_ad_html, keyword, page_key, page_count)
-                        if frame_path:
-                            self.screenshot(frame_path, keyword, page_count)
-                    sleep_time = random.uniform(min_sleep, max_sleep)
-                    print("Sleep for {:.1f} secs.".format(sleep_time))
-                    time.sleep(sleep_time)
-                print("第{} / {}個關鍵字完成\t進度: {:.2%}\n".format(keyword_count + self.keyword_last, len(self.keyword_list), keyword[0]/len(self.keyword_list)))
-                keyword_count += 1
-            self.result_end()
+            run = self.open_project(project)
+            if run is not None:
+                self.runs.append(run)
+        scheduler = _Scheduler(self.runs)
+        # One worker per egress profile, each paced on its own
+        workers = [threading.Thread(target=scheduler.work, args=(egress,), daemon=True) for egress in self.egress_list]
+        for worker in workers:
+            worker.start()
+        try:
+            while any(worker.is_alive() for worker in workers):
+                for worker in workers:
+                    worker.join(0.5)
+        finally:
+            scheduler.stop()
+        scheduler.raise_error()
+
+    def open_project(self, project):
+        # Every project keeps its own copy of the per-project state
+        run = copy.copy(self)
+        run.project_name = project
+        print("--{} 執行--".format(run.project_name))
+        run.keyword_last, run.url_last = run.process_check()
+        run.target_list, run.keyword_list = run.get_keyword_and_target(run.project_name)
+        run.target_index = _TargetIndex(run.target_list, int(run.config["Title_part"]["slice"]))
+        if run.keyword_last == None:
+            print("--{} 已完成--\n".format(run.project_name))
+            run.finalize()
+            run.concat()
+            run.remove_temp_dir()
+            run.check_screenshot()
+            return None
+        elif run.keyword_last > 0 or run.url_last > 0:
+            print("從第{}個關鍵字 第{}個目標網址 繼續\n".format(run.keyword_last + 1, run.url_last))
+        run.open_journal()
+        run.pending = enumerate(run.keyword_list[run.keyword_last:], run.keyword_last)
+        return run
+
+    def run_keyword(self, job, egress):
+        # Other workers may be on the other keywords of this project, each
+        # keyword gets its own copy of the state match_html keeps
+        keyword_index, keyword = job
+        task = copy.copy(self)
+        task.keyword_index = keyword_index
+        task.url_last = self.url_last if keyword_index == self.keyword_last else 0
+        task.search_keyword(keyword, egress)
+        self.journal.keyword_done(keyword_index)
+
+    def search_keyword(self, keyword, egress):
+        if self.config.getboolean("Pagination", "single_request"):
+            # Every page in one request, e.g. num=30 for 第一頁 to 第三頁
+            no_ad_tree = self.html_preprocess(keyword[1], 0, egress, num=10 * len(self.page_dict))
+            if no_ad_tree is not None:
+                page_count = "1-{}".format(len(self.page_dict))
+                frame_path = self.search_html(no_ad_tree, keyword, None, page_count, page_size=10)
+                if frame_path:
+                    self.screenshot(frame_path, keyword, page_count)
+        else:
+            early_stop = self.config.getboolean("Pagination", "early_stop")
+            # Targets not found on any page of this keyword yet, a resumed keyword
+            # only looks for the ones after the checkpoint
+            pending = set(range(self.url_last, len(self.target_list)))
+            for page_key, page_parameter in self.page_dict.items():
+                if early_stop and not pending:
+                    print("關鍵字: {} {}\t目標都已找到 略過{}之後".format(keyword[0], keyword[1], page_key))
+                    break
+                no_ad_tree = self.html_preprocess(keyword[1], page_parameter, egress)
+                if no_ad_tree is not None:
+                    page_count = int(page_parameter / 10 + 1)
+                    frame_path = self.search_html(no_ad_tree, keyword, page_key, page_count)
+                    pending -= self.found_targets
+                    if frame_path:
+                        self.screenshot(frame_path, keyword, page_count)
+        self.metrics.count("keywords", self.project_name)
+        print("{} 第{} / {}個關鍵字完成\t進度: {:.2%}\n".format(self.project_name, keyword[0], len(self.keyword_list), keyword[0]/len(self.keyword_list)))
+
+    def finish_project(self):
+        self.journal.flush()
+        if self.pipeline is not None:
+            with self.metrics.stage("drain", project=self.project_name):
+                self.pipeline.drain(self.project_name)
+        # Marked done before result_end, so a crash in between is finished on the next run
+        self.journal.finish()
+        self.journal = None
+        with self.metrics.stage("result_end", project=self.project_name):
+            self.finalize()
+        with self.metrics.stage("concat", project=self.project_name):
             self.concat()
-            self.remove_temp_dir()
-            self.check_screenshot()
-            print("--{} 已完成--\n".format(self.project_name))
-        print("==全部完成 花費時間: {}==".format(str(datetime.now().replace(microsecond=0) - start_time)))
+        self.remove_temp_dir()
+        self.check_screenshot()
+        print("--{} 已完成--\n".format(self.project_name))
+
+
+def _synthetic_serp(seed, results=10):
+    rnd = random.Random(seed)
+    blocks = []
+    for i in range(results):
+        host = "www.site{}.com.tw".format(rnd.randrange(50))
+        path = "/news/{}-{}".format(rnd.randrange(100000), "abcdefgh"[i % 8])
+        blocks.append(
+            '<div class="g"><div class="tF2Cxc"><div class="yuRUbf"><a href="https://{0}{1}">'
+            '<h3 class="LC20lb">標題 {2}</h3><div><cite>{0}</cite></div></a></div>'
+            '<div class="IsZvec">內容摘要 {2}</div></div></div>'.format(host, path, rnd.randrange(100000))
+        )
+    # Real result pages carry a few hundred KB of inline css/js
+    filler = "var _gs_{0}=function(a){{return a+{0};}};".format(seed) * 4000
+    return (
+        '<!DOCTYPE html><html><head><meta content="text/html"><title>bench</title>'
+        '<style>.a{{background:url(//ssl.gstatic.com/a.png)}}</style><script>{}</script></head><body>'
+        '<div class="logo"><a href="/"><img src="/images/nav_logo242.png"></a></div>'
+        '<span itemprop="image" content="/images/branding/og.png"></span>'
+        '<div id="taw">privacy</div><div role="dialog">options</div>'
+        '<div class="C4eCVc">ad</div><div id="rso">{}</div><div class="cu-container">ad</div>'
+        '<div id="footcnt" style="visibility:hidden"></div></body></html>'
+    ).format(filler, "".join(blocks))
+
+
+def benchmark(source=None, rounds=20, target_count=5000, days=30):
+    config = _load_config()
+    if source is not None and not source.startswith("http"):
+        source = os.path.abspath(source)
+    cwd = os.getcwd()
+    with tempfile.TemporaryDirectory() as bench_dir:
+        os.chdir(bench_dir)
+        try:
+            if source is None:
+                source = "./fixture"
+                os.makedirs(source)
+                for seed in range(5):
+                    with open("{}/bench_{}.html".format(source, seed), "w", encoding="utf-8") as save:
+                        save.write(_synthetic_serp(seed))
+            Gs = G_search(config=config, replay=source)
+            Gs.project_name = "bench"
+            fetcher = Gs.egress_profiles()[0].fetcher
+            pages = [fetcher.fetch("http://www.google.com/search?q=bench{}&start=0".format(i)) for i in range(rounds)]
+
+            # Parsing: clean_page over every replayed page
+            bench_start = time.perf_counter()
+            trees = [Gs.clean_page(page) for page in pages]
+            parse_secs = time.perf_counter() - bench_start
+            print("解析 {} 頁 {:.2f} 秒\t{:.1f} 頁/秒".format(len(pages), parse_secs, len(pages) / parse_secs))
+
+            # Matching: a large synthetic target list mixed with urls seen on the pages
+            hrefs = [a.get("href") for tree in trees for a in tree.xpath("//*[@id='rso']//a[@href]")]
+            rnd = random.Random(0)
+            Gs.target_list = [[i + 1, "目標標題 {}".format(i), "https://www.target{}.com/news/{}-x".format(i % 500, i)] for i in range(target_count)]
+            for href in hrefs[::3]:
+                Gs.target_list[rnd.randrange(target_count)][2] = href
+            bench_start = time.perf_counter()
+            Gs.target_index = _TargetIndex(Gs.target_list, int(config["Title_part"]["slice"]))
+            index_secs = time.perf_counter() - bench_start
+            bench_start = time.perf_counter()
+            for href in hrefs:
+                Gs.target_index.match(href, "")
+            lookup_secs = time.perf_counter() - bench_start
+            print("目標索引 {} 筆 {:.3f} 秒\t比對 {} 個結果 {:.0f} 個/秒".format(
+                target_count, index_secs, len(hrefs), len(hrefs) / lookup_secs if lookup_secs else 0))
+            Gs.keyword_last = Gs.url_last = 0
+            Gs.open_journal()
+            bench_start = time.perf_counter()
+            # Keep the per-hit messages out of the report
+            with redirect_stdout(io.StringIO()):
+                for i, tree in enumerate(trees):
+                    Gs.keyword_index = i
+                    Gs.search_html(tree, [i + 1, "bench{}".format(i)], "第一頁", 1)
+                    Gs.journal.keyword_done(i)
+                Gs.journal.flush()
+            match_secs = time.perf_counter() - bench_start
+            print("search_html {} 頁 {:.2f} 秒\t{:.1f} 頁/秒".format(len(trees), match_secs, len(trees) / match_secs))
+
+            # Aggregation: result_end on today's rows and concat over the whole history
+            result_dir = "./project/bench/result"
+            for day in range(1, days):
+                day_str = "2000{:02d}{:02d}".format(day // 28 + 1, day % 28 + 1)
+                with open("{}/result_bench_{}.csv".format(result_dir, day_str), "w", encoding="utf-8-sig") as save:
+                    save.write("序號,W,操作關鍵字,標題,操作網址,搜尋結果頁,{}/{}/{}\n".format(day_str[:4], day_str[4:6], day_str[6:]))
+                    for t in range(0, target_count, 7):
+                        save.write("{},{},\"bench{}\",\"目標標題\",\"https://t/{}\",第一頁,1\n".format(t + 1, t % 97 + 1, t % 97, t))
+            bench_start = time.perf_counter()
+            Gs.result_end()
+            end_secs = time.perf_counter() - bench_start
+            bench_start = time.perf_counter()
+            Gs.concat()
+            concat_secs = time.perf_counter() - bench_start
+            print("result_end {:.2f} 秒\tconcat {} 天 {:.2f} 秒".format(end_secs, days, concat_secs))
+        finally:
+            os.chdir(cwd)
+
+
+def _fetch(args):
+    Gs = G_search(projects=args.project)
+    Gs.process()
+
+
+def _replay(args):
+    config = _load_config()
+    source = args.replay
+    if not source.startswith("http"):
+        source = os.path.abspath(source)
+    # Replayed days go to their own root, the live result, checkpoint and history stay untouched
+    replay_root = os.path.abspath("./replay/{}".format(datetime.now().strftime("%Y%m%d_%H%M%S")))
+    shutil.copytree("./excel", "{}/excel".format(replay_root))
+    cwd = os.getcwd()
+    os.chdir(replay_root)
+    try:
+        Gs = G_search(config=config, replay=source, projects=args.project)
+        Gs.process()
+    finally:
+        os.chdir(cwd)
+    print("重播結果在 {}".format(replay_root))
+
+
+def _match(args):
+    Gs = G_search(projects=args.project)
+    if not Gs.config.getboolean("Serp_cache", "enable"):
+        sys.exit("[Serp_cache] 未啟用 沒有可以比對的搜尋結果")
+    Gs.cache_only = True
+    try:
+        Gs.process()
+    except _CacheMiss as e:
+        # Nothing is replaced unless every page was there
+        for run in Gs.runs:
+            run.drop_match()
+        sys.exit("快取沒有: {} 今天的結果沒有變動".format(e))
+
+
+def _aggregate(args):
+    Gs = G_search(projects=args.project)
+    for project in Gs.project_list:
+        Gs.project_name = project
+        Gs.aggregate()
+
+
+def _reshoot(args):
+    Gs = G_search(projects=args.project)
+    if args.date:
+        Gs.date_str = args.date
+    try:
+        for project in Gs.project_list:
+            Gs.project_name = project
+            if not os.path.exists("./project/{}/frame/{}".format(project, Gs.date_str)):
+                print("{} {} 沒有html\n".format(project, Gs.date_str))
+                continue
+            print("{} 重截圖".format(project))
+            Gs.re_screenshot()
+            print("{} 重截圖完成\n".format(project))
+    finally:
+        Gs.shot_pool.close()
+
+
+def _status(args):
+    Gs = G_search(projects=args.project)
+    for project in Gs.project_list:
+        Gs.project_name = project
+        print(Gs.status())
+
+
+def _bench(args):
+    benchmark(args.replay)
+
+
+def main():
+    # Without a command it is fetch
+    parser = argparse.ArgumentParser(description="Google 搜尋排名")
+    parser.add_argument("-p", "--project", action="append", metavar="NAME", help="只處理這個專案 (可重複指定)")
+    parser.set_defaults(func=_fetch)
+    # No default on the commands, or it would overwrite a -p given before the command
+    project_arg = argparse.ArgumentParser(add_help=False)
+    project_arg.add_argument("-p", "--project", action="append", metavar="NAME", default=argparse.SUPPRESS, help="只處理這個專案 (可重複指定)")
+    commands = parser.add_subparsers(title="指令", metavar="{fetch,match,aggregate,reshoot,status,replay,bench}")
+
+    fetch = commands.add_parser("fetch", parents=[project_arg], help="搜尋、比對、截圖並合併結果 (預設)")
+    fetch.set_defaults(func=_fetch)
+    match = commands.add_parser("match", parents=[project_arg], help="用今天快取的搜尋結果重新比對")
+    match.set_defaults(func=_match)
+    aggregate = commands.add_parser("aggregate", parents=[project_arg], help="整理今天的結果 (result_end) 並合併歷史 (concat)")
+    aggregate.set_defaults(func=_aggregate)
+    reshoot = commands.add_parser("reshoot", parents=[project_arg], help="補截缺少的截圖")
+    reshoot.add_argument("--date", metavar="YYYYMMDD", help="哪一天的html (預設今天)")
+    reshoot.set_defaults(func=_reshoot)
+    status = commands.add_parser("status", parents=[project_arg], help="各專案今天的進度")
+    status.set_defaults(func=_status)
+    replay = commands.add_parser("replay", parents=[project_arg], help="用保存的SERP html目錄或本機HTTP伺服器取代Google")
+    replay.add_argument("replay", metavar="SOURCE")
+    replay.set_defaults(func=_replay)
+    bench = commands.add_parser("bench", help="效能測試")
+    bench.add_argument("--replay", metavar="SOURCE", help="指定SERP html目錄或本機HTTP伺服器")
+    bench.set_defaults(func=_bench)
+
+    args = parser.parse_args()
+    args.func(args)
+
 
-Gs = G_search()
-Gs.process()
\ No newline at end of file
+if __name__ == "__main__":
+    main()
\ No newline at end of file